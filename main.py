@@ -1,85 +1,296 @@
+import logging
+import math
+import selectors
 import socket
 import time
 import os
 import sys
 
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+logger = logging.getLogger(__name__)
+
 ip_address = os.getenv('IP_ADDRESS')
 port = os.getenv('PORT', '13013')  # Default to 13013 if PORT is not specified
 target_pwr = os.getenv('TARGET_PWR')
+drive_step_gain = os.getenv('DRIVE_STEP_GAIN', '0.2')  # Drive units per watt of error
+power_tolerance = os.getenv('POWER_TOLERANCE', '0')  # Watts either side of target left alone
 
 # Exit if no IP address or target_pwr is specified
 if not ip_address:
-    print("No IP address specified. Exiting...")
+    logger.error("No IP address specified. Exiting...")
     sys.exit(1)
 
 if not target_pwr:
-    print("No target power specified. Exiting...")
+    logger.error("No target power specified. Exiting...")
     sys.exit(1)
 
 try:
     port = int(port)
     target_pwr = int(target_pwr)
 except ValueError:
-    print("Port and Target Power must be integers. Exiting...")
+    logger.error("Port and Target Power must be integers. Exiting...")
+    sys.exit(1)
+
+try:
+    drive_step_gain = float(drive_step_gain)
+    power_tolerance = int(power_tolerance)
+except ValueError:
+    logger.error("Drive Step Gain must be a number and Power Tolerance an integer. Exiting...")
     sys.exit(1)
 
-print(f"Using IP: {ip_address}")
-print(f"Using Port: {port}")
-print(f"Using Target Power: {target_pwr}")
+if not math.isfinite(drive_step_gain) or drive_step_gain < 0 or power_tolerance < 0:
+    logger.error("Drive Step Gain must be a finite non-negative number and Power Tolerance non-negative. Exiting...")
+    sys.exit(1)
+
+logger.info("Using IP: %s", ip_address)
+logger.info("Using Port: %d", port)
+logger.info("Using Target Power: %d", target_pwr)
+logger.info("Using Drive Step Gain: %s", drive_step_gain)
+logger.info("Using Power Tolerance: %d", power_tolerance)
+
+# Fixed CAT commands, encoded once
+ZZRM5_CMD = b'ZZRM5;'
+ZZPC_QUERY = b'ZZPC;'
+POLL_CMD = ZZRM5_CMD + ZZPC_QUERY
+ZZRM5_PREFIX = b'ZZRM5'
+ZZPC_PREFIX = b'ZZPC'
+
+MIN_DRIVE_LEVEL = 0
+MAX_DRIVE_LEVEL = 100
+
+# Drive at or above the threshold is treated as runaway and dropped to the reset value
+DRIVE_RESET_THRESHOLD = 60
+DRIVE_RESET_VALUE = 10
+
+# Power at or below this is considered not transmitting, so drive is never raised
+# unless the reading follows a decrease made by the controller itself, and then
+# only back up to the level from before that decrease
+TX_POWER_THRESHOLD = 3
+
+# Most drive units a single adjustment may move
+MAX_DRIVE_STEP = 5
+
+# Every possible drive set command, indexed by drive level
+ZZPC_CMDS = tuple(f'ZZPC{i:03d};'.encode('ascii') for i in range(MAX_DRIVE_LEVEL + 1))
+
+READ_BUFFER_SIZE = 4096
+SOCKET_RCVBUF_SIZE = 65536
+
+# Control loop period, the slower period while the radio isn't transmitting,
+# and the wait after the radio answers a power query with '?;'
+LOOP_DELAY = 0.1
+IDLE_LOOP_DELAY = 0.5
+NO_RESPONSE_DELAY = 1
+
+# Seconds between logged power readings
+LOG_INTERVAL = 1
+
+# Seconds between reads of the drive level, to pick up changes made at the radio
+DRIVE_RESYNC_INTERVAL = 30
+
+# Seconds to wait for the CAT server to answer a query
+RESPONSE_TIMEOUT = 1.0
+
+# Seconds to wait for the TCP connection and welcome message
+CONNECT_TIMEOUT = 5.0
+
+# Reconnect backoff bounds, in seconds
+RECONNECT_DELAY_MIN = 1
+RECONNECT_DELAY_MAX = 30
 
-def send_command(sock, command, prefix = "", suffix = "", read_response = True):
+# Seconds a session must stay up before the reconnect delay resets to the minimum
+STABLE_SESSION_SECONDS = 30
+
+# (host, port) -> resolved socket address
+_resolved_addrs = {}
+
+# Bytes that may appear between ';'-terminated records
+RECORD_SEPARATORS = b'\r\n '
+
+# Bytes received from the CAT server that haven't been returned as a record yet
+_recv_buf = bytearray()
+
+def read_record(sock, selector):
+    # CAT responses are ';'-terminated; return the next complete one, waiting
+    # on the selector for more data when the buffer doesn't hold one yet
+    while True:
+        end = _recv_buf.find(b';')
+        if end >= 0:
+            # Skip any line ending the server put after the previous record, so
+            # records come back exactly as b'ZZRM5100 W;' and need no strip()
+            start = 0
+            while _recv_buf[start] in RECORD_SEPARATORS:
+                start += 1
+            record = bytes(_recv_buf[start:end + 1])
+            del _recv_buf[:end + 1]
+            return record
+        if not selector.select(RESPONSE_TIMEOUT):
+            raise socket.timeout("no response from the CAT server")
+        try:
+            data = sock.recv(READ_BUFFER_SIZE)
+        except BlockingIOError:
+            continue
+        if not data:
+            raise ConnectionError("CAT server closed the connection")
+        _recv_buf.extend(data)
+
+def parse_pwr(response):
+    # b'ZZRM5<watts> W;'
+    return int(response[5:-3])
+
+def parse_drive(response):
+    # b'ZZPC<level>;'
+    return int(response[4:-1])
+
+def read_response(sock, selector, prefix, parser):
+    while True:  # Keep reading until a valid response is found
+        response = read_record(sock, selector)
+        if response.startswith(prefix):
+            return parser(response)
+        if response == b'?;':
+            return None
+        logger.warning("response %r didn't start with %r", response, prefix)
+
+def send_command(sock, selector, command, prefix, parser):
+    sock.sendall(command)
+    return read_response(sock, selector, prefix, parser)
+
+def poll_power_and_drive(sock, selector):
+    # Pipeline both queries in one write; the answers come back in order
+    sock.sendall(POLL_CMD)
+    current_pwr = read_response(sock, selector, ZZRM5_PREFIX, parse_pwr)
+    current_drive = read_response(sock, selector, ZZPC_PREFIX, parse_drive)
+    return current_pwr, current_drive
+
+def calculate_drive_adjustment(current_pwr, current_drive, raise_limit=None):
+    # Returns the drive level to set, or None to leave it alone.
+    # raise_limit is the drive level from before a decrease the controller
+    # made on the previous tick, or None. A low reading right after such a
+    # decrease may be our own overshoot rather than the radio in receive, so
+    # drive may be raised, but never above where it was before the decrease
+    if current_drive >= DRIVE_RESET_THRESHOLD:
+        return DRIVE_RESET_VALUE
+    error = target_pwr - current_pwr
+    if abs(error) <= power_tolerance:
+        return None
+    recovering = error > 0 and current_pwr <= TX_POWER_THRESHOLD
+    if recovering and raise_limit is None:
+        return None
+    # Step proportionally to the error, by at least one and at most
+    # MAX_DRIVE_STEP units, so a lagging meter can't drive it straight to zero
+    step = min(max(round(drive_step_gain * error), -MAX_DRIVE_STEP), MAX_DRIVE_STEP)
+    if step == 0:
+        step = 1 if error > 0 else -1
+    next_drive = min(max(current_drive + step, MIN_DRIVE_LEVEL), DRIVE_RESET_THRESHOLD - 1)
+    if recovering:
+        next_drive = min(next_drive, raise_limit)
+    if next_drive == current_drive:
+        return None
+    return next_drive
+
+def recovery_limit(current_drive, next_drive):
+    # The raise_limit to pass on the tick after changing drive: the previous
+    # level for a proportional decrease, None for a raise or a runaway reset
+    if next_drive < current_drive < DRIVE_RESET_THRESHOLD:
+        return current_drive
+    return None
+
+def resolve(ip, port):
+    # Reconnects reuse the address from the first successful lookup
+    addr = _resolved_addrs.get((ip, port))
+    if addr is None:
+        addr = socket.getaddrinfo(ip, port, socket.AF_INET, socket.SOCK_STREAM)[0][4]
+        _resolved_addrs[(ip, port)] = addr
+    return addr
+
+def connect_once(ip, port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     try:
-        sock.sendall((command).encode('utf-8'))
-        if read_response:
-             while True:  # Keep reading until a valid response is found
-                response = sock.recv(1024).decode('utf-8').strip()
-                # Check if the response starts with the desired prefix and process it
-                if response.startswith(prefix) or response == '?;':
-                    processed_response = response.removeprefix(prefix).removesuffix(suffix).strip()
-                    if processed_response == '?;':
-                        return ""
-                    return processed_response
-                else:
-                    print("response ", response, " didn't start with ", prefix)
-        return ""
-    except socket.error as e:
-        return str(e)
+        # Commands are a few bytes each, so don't let Nagle hold them back
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_RCVBUF_SIZE)
+        sock.settimeout(CONNECT_TIMEOUT)
+
+        # Connect to the server
+        try:
+            sock.connect(resolve(ip, port))
+        except OSError:
+            _resolved_addrs.pop((ip, port), None)
+            raise
+        logger.info("Connected to the CAT server: %s", sock.recv(1024).decode('utf-8').strip())
+        sock.setblocking(False)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+def run_loop(sock, selector):
+    _recv_buf.clear()
+    current_drive = None  # last drive level sent to or read from the radio
+    raise_limit = None  # drive level before the previous tick's decrease
+    next_tick = time.monotonic()
+    last_sync = next_tick
+    last_log = next_tick - LOG_INTERVAL
+    was_in_tx = True
+    while True:
+        # The radio accepts every ZZPC set, so the drive level is only read
+        # back on the first tick and periodically to catch manual changes
+        if current_drive is None or next_tick - last_sync >= DRIVE_RESYNC_INTERVAL:
+            current_pwr, current_drive = poll_power_and_drive(sock, selector)
+            last_sync = next_tick
+        else:
+            current_pwr = send_command(sock, selector, ZZRM5_CMD, ZZRM5_PREFIX, parse_pwr)
+
+        if current_pwr is not None:
+            # Readings arrive at up to 10 Hz, so log at most one per LOG_INTERVAL.
+            # next_tick is a running float sum, so allow half a tick of slack or
+            # ten 0.1 s ticks would fall just short of 1 s
+            if next_tick - last_log >= LOG_INTERVAL - LOOP_DELAY / 2 and logger.isEnabledFor(logging.INFO):
+                last_log = next_tick
+                logger.info("Power Output: %d W (target: %d W)", current_pwr, target_pwr)
+            last_raise_limit = raise_limit
+            raise_limit = None
+            if current_drive is not None and current_pwr != target_pwr:
+                next_drive = calculate_drive_adjustment(current_pwr, current_drive, last_raise_limit)
+                if next_drive is not None:
+                    logger.info("changing drive from %d to %d (power: %d W)", current_drive, next_drive, current_pwr)
+                    sock.sendall(ZZPC_CMDS[next_drive])
+                    raise_limit = recovery_limit(current_drive, next_drive)
+                    current_drive = next_drive
+            # Poll at the full rate while transmitting and for one tick after,
+            # but back off while the radio sits in receive
+            in_tx = current_pwr > TX_POWER_THRESHOLD
+            next_tick += LOOP_DELAY if in_tx or was_in_tx else IDLE_LOOP_DELAY
+            was_in_tx = in_tx
+        else:
+            next_tick += NO_RESPONSE_DELAY
+
+        # Sleep to a fixed deadline so the time spent talking to the radio
+        # doesn't stretch the period; after falling behind, restart from now
+        now = time.monotonic()
+        if next_tick > now:
+            time.sleep(next_tick - now)
+        else:
+            next_tick = now
 
 def main(ip, port):
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+    reconnect_delay = RECONNECT_DELAY_MIN
+    while True:
+        session_start = time.monotonic()
         try:
-            # Connect to the server
-            sock.connect((ip, port))
-            print("Connected to the CAT server: " + sock.recv(1024).decode('utf-8').strip())
-            
-            while True:
-                pwr_response = send_command(sock, 'ZZRM5;', "ZZRM5", " W;")
-                
-                if pwr_response:
-                    print("Power Output:", pwr_response, " W")
-                    current_pwr = int(pwr_response);
-                    if current_pwr > target_pwr or current_pwr < target_pwr:
-                        current_drive_response = send_command(sock, 'ZZPC;', "ZZPC", ";")
-                        if current_drive_response:
-                            current_drive = int(current_drive_response);
-                            if (current_drive >= 60):
-                                next_drive = 10
-                                print("changing drive from ", current_drive, " to ", next_drive)
-                                send_command(sock, 'ZZPC' + str(next_drive).zfill(3) + ';', "", "", False)
-                            elif (current_pwr > target_pwr):
-                                next_drive = current_drive - 1
-                                print("changing drive from ", current_drive, " to ", next_drive)
-                                send_command(sock, 'ZZPC' + str(next_drive).zfill(3) + ';', "", "", False)
-                            elif (current_pwr > 3 and current_pwr < target_pwr):
-                                next_drive = current_drive + 1
-                                print("changing drive from ", current_drive, " to ", next_drive)
-                                send_command(sock, 'ZZPC' + str(next_drive).zfill(3) + ';', "", "", False)
-                    time.sleep(0.1)
-                else:
-                    time.sleep(1)
-        
+            with connect_once(ip, port) as sock, selectors.DefaultSelector() as selector:
+                selector.register(sock, selectors.EVENT_READ)
+                run_loop(sock, selector)
         except Exception as e:
-            print("failed to connect or error during the session:", str(e))
+            logger.error("failed to connect or error during the session: %s", e)
+        # Only a session that stayed up counts as recovered; a server that
+        # accepts connections but never answers keeps backing off
+        if time.monotonic() - session_start >= STABLE_SESSION_SECONDS:
+            reconnect_delay = RECONNECT_DELAY_MIN
+        logger.info("Reconnecting in %d s", reconnect_delay)
+        time.sleep(reconnect_delay)
+        reconnect_delay = min(reconnect_delay * 2, RECONNECT_DELAY_MAX)
 
 # Run the main function
-main(ip_address, port)
+if __name__ == '__main__':
+    main(ip_address, port)
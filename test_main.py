@@ -0,0 +1,52 @@
+import os
+import unittest
+
+# main.py reads its settings from the environment at import
+os.environ.update({
+    'IP_ADDRESS': '127.0.0.1',
+    'TARGET_PWR': '100',
+    'DRIVE_STEP_GAIN': '0.2',
+    'POWER_TOLERANCE': '0',
+})
+
+import main
+
+
+def step(current_pwr, current_drive, raise_limit):
+    # One control tick as run_loop does it: (next drive or None, next raise_limit)
+    next_drive = main.calculate_drive_adjustment(current_pwr, current_drive, raise_limit)
+    if next_drive is None:
+        return None, None
+    return next_drive, main.recovery_limit(current_drive, next_drive)
+
+
+class DriveAdjustmentTest(unittest.TestCase):
+    def test_runaway_reset_in_receive_is_not_raised_again(self):
+        next_drive, limit = step(0, 70, None)
+        self.assertEqual(next_drive, main.DRIVE_RESET_VALUE)
+        self.assertEqual(step(0, next_drive, limit), (None, None))
+
+    def test_unkey_after_overshoot_does_not_raise_past_previous_level(self):
+        next_drive, limit = step(101, 30, None)
+        self.assertEqual(next_drive, 29)
+        next_drive, limit = step(0, next_drive, limit)
+        self.assertLessEqual(next_drive, 30)
+        # Still in receive: no further raises
+        self.assertEqual(step(0, next_drive, limit), (None, None))
+
+    def test_overshoot_below_tx_threshold_recovers(self):
+        next_drive, limit = step(250, 5, None)
+        self.assertEqual(next_drive, 0)
+        next_drive, limit = step(0, next_drive, limit)
+        self.assertEqual(next_drive, 5)
+
+    def test_step_is_capped(self):
+        self.assertEqual(main.calculate_drive_adjustment(250, 50, None), 50 - main.MAX_DRIVE_STEP)
+        self.assertEqual(main.calculate_drive_adjustment(20, 30, None), 30 + main.MAX_DRIVE_STEP)
+
+    def test_receive_never_raises_without_a_prior_decrease(self):
+        self.assertIsNone(main.calculate_drive_adjustment(0, 20, None))
+
+
+if __name__ == '__main__':
+    unittest.main()